@@ -4,24 +4,101 @@ SIP сервер для прямого перехвата звонков
 Использует SIP/RTP для телефонии без веб-интерфейса
 """
 
+import atexit
+import functools
+import os
 import socket
-import threading
 import struct
-import hashlib
+import sys
 import time
 import re
-from datetime import datetime
+import queue
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 import logging
-from sip_voice_ai_engine import VoiceAIEngine
+from logging.handlers import QueueHandler, QueueListener
+from sip_voice_ai_engine import VoiceAIEngine, FALLBACK_RESPONSES
 from sip_speech_processor import SpeechProcessor
 
-# Настройка логирования
+# Настройка логирования: потоки звонков только кладут записи в очередь,
+# запись в поток вывода (файл логов) выполняет отдельный поток QueueListener
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[QueueHandler(log_queue)]
 )
 logger = logging.getLogger(__name__)
 
+# Заголовки запроса, которые копируются в ответ
+COPIED_HEADERS = ('Via', 'From', 'To', 'Call-ID', 'CSeq')
+
+# Окончание ответа без тела (200 OK на REGISTER/BYE/OPTIONS и т.п.)
+EMPTY_BODY_TAIL = "Content-Length: 0\r\n\r\n"
+
+# SIP URI в заголовке From/To: <sip:user@host>
+SIP_URI_RE = re.compile(r'<sip:(.+?)>')
+
+# Адрес и порт RTP абонента в SDP теле INVITE
+SDP_CONNECTION_RE = re.compile(r'^c=IN IP4 (\S+)', re.MULTILINE)
+SDP_AUDIO_PORT_RE = re.compile(r'^m=audio (\d+)', re.MULTILINE)
+
+# Граница предложений в ответе AI: пробел после . ! ? или …
+SENTENCE_END_RE = re.compile(r'(?<=[.!?…])\s+')
+
+# Фиксированный RTP заголовок (RFC 3550) без CSRC
+RTP_HEADER = struct.Struct('!BBHII')
+
+# Размер пула потоков для обработки SIP сообщений
+SIP_WORKERS = int(os.getenv('SIP_WORKERS', '16'))
+
+# Максимум одновременно обслуживаемых звонков (размер пула потоков звонков)
+MAX_CALLS = int(os.getenv('MAX_CALLS', '50'))
+
+# Завершение звонка после стольких секунд без RTP пакетов (потерянный BYE)
+RTP_TIMEOUT = int(os.getenv('RTP_TIMEOUT', '30'))
+
+# Размер пула потоков для AI обработки аудио
+AI_WORKERS = int(os.getenv('AI_WORKERS', '4'))
+
+# Время жизни определенного локального IP адреса (секунды)
+LOCAL_IP_TTL = 30.0
+
+# Задержка перед автоматическим ответом на входящий звонок (секунды)
+ANSWER_DELAY = 1.0
+
+@functools.lru_cache(maxsize=256)
+def build_sdp(local_ip, rtp_port):
+    """SDP тело ответа; зависит только от IP и RTP порта, поэтому кэшируется"""
+    return f"""v=0
+o=- 0 0 IN IP4 {local_ip}
+s=-
+c=IN IP4 {local_ip}
+t=0 0
+m=audio {rtp_port} RTP/AVP 0 8 101
+a=rtpmap:0 PCMU/8000
+a=rtpmap:8 PCMA/8000
+a=rtpmap:101 telephone-event/8000
+a=sendrecv
+"""
+
+def log_task_error(future):
+    """Лог исключения задачи пула потоков: иначе оно молча остается в Future"""
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        logger.error("❌ Ошибка в фоновой задаче: %s", error, exc_info=error)
+
+def split_sentences(text):
+    """Разбиение текста на предложения для поэтапного синтеза речи"""
+    return [sentence for sentence in SENTENCE_END_RE.split(text.strip()) if sentence]
+
 class SIPServer:
     def __init__(self, local_ip='0.0.0.0', sip_port=5060, rtp_port=10000):
         self.local_ip = local_ip
@@ -29,77 +106,127 @@ class SIPServer:
         self.rtp_port = rtp_port
         self.calls = {}
         self.registered_users = {}
+        self.detected_ip = None
+        self.detected_ip_expires = 0.0
+        
+        # Свободные RTP порты: по одному на звонок, возвращаются после завершения.
+        # Порт base + len(calls) совпадал с портом живого звонка после любого BYE
+        self.free_rtp_ports = deque(range(rtp_port, rtp_port + MAX_CALLS))
+        
+        # Обработчики поддерживаемых SIP методов
+        self.method_handlers = {
+            'REGISTER': self.handle_register,
+            'INVITE': self.handle_invite,
+            'ACK': self.handle_ack,
+            'BYE': self.handle_bye,
+            'OPTIONS': self.handle_options,
+        }
         
         # AI компоненты
         self.ai_engine = VoiceAIEngine()
         self.speech_processor = SpeechProcessor()
         
+        # Ограниченный пул потоков для обработки SIP сообщений
+        self.sip_executor = ThreadPoolExecutor(
+            max_workers=SIP_WORKERS, thread_name_prefix='sip'
+        )
+        
+        # Пул потоков звонков: один поток на звонок от ответа до завершения RTP
+        self.call_executor = ThreadPoolExecutor(
+            max_workers=MAX_CALLS, thread_name_prefix='call'
+        )
+        
+        # Ограниченный пул потоков для AI обработки аудио (STT -> LLM -> TTS)
+        self.ai_executor = ThreadPoolExecutor(
+            max_workers=AI_WORKERS, thread_name_prefix='ai'
+        )
+        
+        # Пул воспроизведения ответов: отправка RTP идет в реальном времени
+        # (20мс на пакет), поэтому не занимает ни пул AI, ни поток приема RTP.
+        # Не более одного ответа на звонок, поэтому пул рассчитан на MAX_CALLS
+        self.playback_executor = ThreadPoolExecutor(
+            max_workers=MAX_CALLS, thread_name_prefix='playback'
+        )
+        
+        # Пул синтеза речи: следующее предложение ответа синтезируется, пока
+        # звучит текущее (не более одной задачи на звонок)
+        self.tts_executor = ThreadPoolExecutor(
+            max_workers=AI_WORKERS, thread_name_prefix='tts'
+        )
+        
+        # Фиксированные ответы об ошибках синтезируются заранее в фоне:
+        # при недоступном Ollama они звучат без задержки на синтез.
+        # Кэш заполняется по предложениям, как они озвучиваются в звонке
+        for phrase in FALLBACK_RESPONSES:
+            for sentence in split_sentences(phrase):
+                self.tts_executor.submit(
+                    self.speech_processor.text_to_audio, sentence, persist=True
+                ).add_done_callback(log_task_error)
+        
         # SIP сокет
         self.sip_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sip_socket.bind((self.local_ip, self.sip_port))
         
-        logger.info(f"🚀 SIP сервер запущен на {local_ip}:{sip_port}")
+        logger.info("🚀 SIP сервер запущен на %s:%s", local_ip, sip_port)
         
     def run(self):
         """Запуск SIP сервера"""
         while True:
             try:
                 data, addr = self.sip_socket.recvfrom(65535)
-                message = data.decode('utf-8')
-                logger.info(f"📨 Получено SIP сообщение от {addr}")
-                logger.debug(f"Сообщение:\n{message}")
                 
-                # Обработка SIP сообщения в отдельном потоке
-                thread = threading.Thread(target=self.handle_sip_message, args=(message, addr))
-                thread.start()
+                # Декодирование и обработка SIP сообщения в пуле потоков,
+                # цикл приема только читает датаграммы из сокета
+                self.sip_executor.submit(
+                    self.handle_sip_message, data, addr
+                ).add_done_callback(log_task_error)
                 
             except Exception as e:
-                logger.error(f"❌ Ошибка в SIP сервере: {e}")
+                logger.error("❌ Ошибка в SIP сервере: %s", e)
                 
-    def handle_sip_message(self, message, addr):
+    def handle_sip_message(self, data, addr):
         """Обработка SIP сообщения"""
         try:
-            # Парсинг SIP заголовков
-            lines = message.split('\r\n')
-            method = lines[0].split()[0]
+            message = data.decode('utf-8')
+            logger.debug("Сообщение от %s:\n%s", addr, message)
             
+            # Заголовки отделены от тела (SDP) пустой строкой; тело не разбираем
+            head = message.partition('\r\n\r\n')[0]
+            lines = head.split('\r\n')
+            method = lines[0].split(' ', 1)[0]
+            
+            # Ответы (SIP/2.0 ...) и неподдерживаемые методы не разбираем
+            handler = self.method_handlers.get(method)
+            if handler is None:
+                logger.debug("Пропуск SIP сообщения: %s", lines[0])
+                return
+            
+            # Парсинг SIP заголовков
             headers = {}
             for line in lines[1:]:
                 if ':' in line:
                     key, value = line.split(':', 1)
                     headers[key.strip()] = value.strip()
             
-            logger.info(f"📞 SIP метод: {method}")
+            # Одна запись на сообщение вместо отдельных строк в каждом обработчике
+            logger.info("📨 SIP %s от %s, Call-ID: %s", method, addr, headers.get('Call-ID', ''))
             
-            if method == 'REGISTER':
-                self.handle_register(message, headers, addr)
-            elif method == 'INVITE':
-                self.handle_invite(message, headers, addr)
-            elif method == 'ACK':
-                self.handle_ack(message, headers, addr)
-            elif method == 'BYE':
-                self.handle_bye(message, headers, addr)
-            elif method == 'OPTIONS':
-                self.handle_options(message, headers, addr)
+            handler(message, headers, addr)
                 
         except Exception as e:
-            logger.error(f"❌ Ошибка обработки SIP: {e}")
+            logger.error("❌ Ошибка обработки SIP: %s", e)
             
     def handle_register(self, message, headers, addr):
         """Обработка REGISTER запроса"""
-        logger.info(f"📝 Обработка REGISTER от {addr}")
-        
         # Простая регистрация без аутентификации для демо
         from_header = headers.get('From', '')
-        to_header = headers.get('To', '')
-        call_id = headers.get('Call-ID', '')
         
         # Извлекаем SIP URI
-        sip_uri_match = re.search(r'<sip:(.+?)>', from_header)
+        sip_uri_match = SIP_URI_RE.search(from_header)
         if sip_uri_match:
             sip_uri = sip_uri_match.group(1)
             self.registered_users[sip_uri] = addr
-            logger.info(f"✅ Пользователь {sip_uri} зарегистрирован")
+            logger.info("✅ Пользователь %s зарегистрирован", sip_uri)
         
         # Отправляем 200 OK
         response = self.create_response(message, headers, 200, 'OK')
@@ -107,52 +234,139 @@ class SIPServer:
         
     def handle_invite(self, message, headers, addr):
         """Обработка INVITE запроса (входящий звонок)"""
-        logger.info(f"📞 Входящий звонок от {addr}")
-        
         call_id = headers.get('Call-ID', '')
+        
+        # Повтор INVITE (ретрансмиссия по UDP, пока нет окончательного ответа):
+        # звонок уже обрабатывается, повторяем последний ответ
+        call = self.calls.get(call_id)
+        if call is not None:
+            if call['state'] == 'ringing':
+                response = self.create_response(message, headers, 180, 'Ringing')
+            else:
+                response = self.create_200_ok_with_sdp(message, headers, call['rtp_port'])
+            self.sip_socket.sendto(response.encode(), addr)
+            logger.debug("Повтор INVITE для звонка %s", call_id)
+            return
+            
+        # Все RTP порты заняты - сервер на пределе MAX_CALLS
+        try:
+            rtp_port = self.free_rtp_ports.popleft()
+        except IndexError:
+            logger.warning("⚠️ Достигнут предел одновременных звонков (%s)", MAX_CALLS)
+            busy_response = self.create_response(message, headers, 486, 'Busy Here')
+            self.sip_socket.sendto(busy_response.encode(), addr)
+            return
+            
         from_header = headers.get('From', '')
         to_header = headers.get('To', '')
         
+        # Адрес для BYE с нашей стороны (Contact абонента, иначе From)
+        contact_match = SIP_URI_RE.search(headers.get('Contact', '') or from_header)
+        contact = f"sip:{contact_match.group(1)}" if contact_match else f"sip:{addr[0]}:{addr[1]}"
+        
+        # Куда отправлять RTP до первого пакета абонента: адрес из его SDP.
+        # Фильтром приема он не служит - за NAT в SDP указан внутренний адрес
+        sdp = message.partition('\r\n\r\n')[2]
+        connection_match = SDP_CONNECTION_RE.search(sdp)
+        audio_port_match = SDP_AUDIO_PORT_RE.search(sdp)
+        rtp_peer = None
+        if connection_match and audio_port_match:
+            rtp_peer = (connection_match.group(1), int(audio_port_match.group(1)))
+        
         # Сохраняем информацию о звонке
-        self.calls[call_id] = {
+        call = {
             'from': from_header,
             'to': to_header,
             'addr': addr,
+            'contact': contact,
             'state': 'ringing',
-            'rtp_port': self.rtp_port + len(self.calls)
+            'rtp_port': rtp_port,
+            'rtp_peer': rtp_peer,
+            # Состояние RTP потока звонка (RFC 3550): случайные начальные
+            # sequence number и timestamp, продолжаются между ответами
+            'rtp_seq': random.getrandbits(16),
+            'rtp_timestamp': random.getrandbits(32),
+            'rtp_time': None
         }
+        self.calls[call_id] = call
+        
+        # Одна строка на новый звонок; адрес и Call-ID уже в строке 📨 SIP INVITE
+        logger.info("📞 Входящий звонок от %s, RTP порт: %s", from_header, rtp_port)
         
         # Отправляем 100 Trying
         trying_response = self.create_response(message, headers, 100, 'Trying')
         self.sip_socket.sendto(trying_response.encode(), addr)
         
         # Отправляем 180 Ringing
-        time.sleep(0.1)
         ringing_response = self.create_response(message, headers, 180, 'Ringing')
         self.sip_socket.sendto(ringing_response.encode(), addr)
         
-        # Автоматически принимаем звонок через 1 секунду
-        time.sleep(1)
-        
-        # Извлекаем SDP из INVITE
-        sdp_start = message.find('\r\n\r\n') + 4
-        sdp_data = message[sdp_start:] if sdp_start > 3 else ''
-        
-        # Создаем ответ 200 OK с SDP
-        ok_response = self.create_200_ok_with_sdp(message, headers, self.calls[call_id]['rtp_port'])
-        self.sip_socket.sendto(ok_response.encode(), addr)
+        # Модель Ollama загружается, пока звонок звонит: первая реплика
+        # абонента не ждет холодного старта модели. Прогрев идет в своем
+        # фоновом потоке, вызов не блокирует и не занимает пул AI
+        self.ai_engine.warm_up()
         
-        self.calls[call_id]['state'] = 'answered'
-        logger.info(f"✅ Звонок {call_id} принят, RTP порт: {self.calls[call_id]['rtp_port']}")
-        
-        # Запускаем RTP обработчик для этого звонка
-        rtp_thread = threading.Thread(target=self.handle_rtp_stream, args=(call_id,))
-        rtp_thread.start()
+        # Автоматически принимаем звонок через 1 секунду в пуле звонков,
+        # не занимая поток обработки SIP сообщений на время ожидания
+        self.call_executor.submit(
+            self.answer_call, message, headers, addr, call_id, call
+        ).add_done_callback(log_task_error)
         
+    def answer_call(self, message, headers, addr, call_id, call):
+        """Ответ 200 OK на INVITE и обработка RTP потока звонка"""
+        try:
+            # Поток пула принадлежит звонку до его завершения, поэтому ожидание
+            # здесь не задерживает другие звонки
+            time.sleep(ANSWER_DELAY)
+            
+            # Звонок мог быть завершен, пока шел вызов
+            if self.calls.get(call_id) is not call:
+                logger.info("📞 Звонок %s завершен до ответа", call_id)
+                return
+            
+            # RTP сокет открывается до 200 OK: если порт занят, абонент получает
+            # отказ, а не принятый звонок без звука
+            try:
+                rtp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                try:
+                    rtp_socket.bind(('0.0.0.0', call['rtp_port']))
+                except OSError:
+                    rtp_socket.close()
+                    raise
+                rtp_socket.settimeout(1.0)
+            except OSError as e:
+                logger.error("❌ RTP порт %s недоступен, звонок %s отклонен: %s", call['rtp_port'], call_id, e)
+                error_response = self.create_response(message, headers, 503, 'Service Unavailable')
+                self.sip_socket.sendto(error_response.encode(), addr)
+                return
+            
+            try:
+                # Создаем ответ 200 OK с SDP
+                ok_response = self.create_200_ok_with_sdp(message, headers, call['rtp_port'])
+                self.sip_socket.sendto(ok_response.encode(), addr)
+                
+                call['state'] = 'answered'
+                logger.info("✅ Звонок %s принят", call_id)
+                
+            except Exception as e:
+                logger.error("❌ Ошибка ответа на звонок %s: %s", call_id, e)
+                rtp_socket.close()
+                return
+                
+            # RTP обработчик работает в этом же потоке, отдельный поток не нужен
+            self.handle_rtp_stream(call_id, call, rtp_socket)
+            
+        finally:
+            # Звонок завершен (BYE, ошибка или тишина в RTP): удаляем запись
+            # и возвращаем RTP порт в пул
+            if self.calls.get(call_id) is call:
+                self.calls.pop(call_id, None)
+            call['state'] = 'ended'
+            self.free_rtp_ports.append(call['rtp_port'])
+            
     def handle_ack(self, message, headers, addr):
         """Обработка ACK"""
         call_id = headers.get('Call-ID', '')
-        logger.info(f"✅ ACK получен для звонка {call_id}")
         
         if call_id in self.calls:
             self.calls[call_id]['state'] = 'active'
@@ -160,59 +374,64 @@ class SIPServer:
     def handle_bye(self, message, headers, addr):
         """Обработка BYE (завершение звонка)"""
         call_id = headers.get('Call-ID', '')
-        logger.info(f"📞 Завершение звонка {call_id}")
+        logger.debug("📞 Завершение звонка %s", call_id)
         
         # Отправляем 200 OK
         response = self.create_response(message, headers, 200, 'OK')
         self.sip_socket.sendto(response.encode(), addr)
         
-        # Удаляем информацию о звонке
-        if call_id in self.calls:
-            del self.calls[call_id]
+        # Удаляем информацию о звонке; RTP обработчик видит состояние 'ended'
+        call = self.calls.pop(call_id, None)
+        if call is not None:
+            call['state'] = 'ended'
             
     def handle_options(self, message, headers, addr):
         """Обработка OPTIONS (проверка доступности)"""
         response = self.create_response(message, headers, 200, 'OK')
         self.sip_socket.sendto(response.encode(), addr)
         
+    def send_bye(self, call_id, call):
+        """Завершение звонка с нашей стороны (BYE по данным диалога из INVITE)"""
+        try:
+            # Наша сторона диалога - To из INVITE, сторона абонента - From
+            bye = ''.join([
+                f"BYE {call['contact']} SIP/2.0\r\n",
+                f"Via: SIP/2.0/UDP {self.get_local_ip()}:{self.sip_port};branch=z9hG4bK{os.urandom(8).hex()}\r\n",
+                "Max-Forwards: 70\r\n",
+                f"From: {call['to']}\r\n",
+                f"To: {call['from']}\r\n",
+                f"Call-ID: {call_id}\r\n",
+                "CSeq: 1 BYE\r\n",
+                EMPTY_BODY_TAIL,
+            ])
+            self.sip_socket.sendto(bye.encode(), call['addr'])
+        except Exception as e:
+            logger.error("❌ Ошибка отправки BYE для звонка %s: %s", call_id, e)
+            
     def create_response(self, request, headers, code, reason):
-        """Создание SIP ответа"""
-        lines = request.split('\r\n')
-        request_line = lines[0]
-        
-        response = f"SIP/2.0 {code} {reason}\r\n"
+        """Создание SIP ответа без тела"""
+        parts = [f"SIP/2.0 {code} {reason}\r\n"]
         
         # Копируем важные заголовки
-        for header in ['Via', 'From', 'To', 'Call-ID', 'CSeq']:
+        for header in COPIED_HEADERS:
             if header in headers:
-                response += f"{header}: {headers[header]}\r\n"
+                parts.append(f"{header}: {headers[header]}\r\n")
                 
-        response += f"Content-Length: 0\r\n"
-        response += "\r\n"
+        parts.append(EMPTY_BODY_TAIL)
         
-        return response
+        return ''.join(parts)
         
     def create_200_ok_with_sdp(self, request, headers, rtp_port):
         """Создание 200 OK ответа с SDP"""
         response = f"SIP/2.0 200 OK\r\n"
         
         # Копируем заголовки
-        for header in ['Via', 'From', 'To', 'Call-ID', 'CSeq']:
+        for header in COPIED_HEADERS:
             if header in headers:
                 response += f"{header}: {headers[header]}\r\n"
                 
         # SDP тело
-        sdp = f"""v=0
-o=- 0 0 IN IP4 {self.get_local_ip()}
-s=-
-c=IN IP4 {self.get_local_ip()}
-t=0 0
-m=audio {rtp_port} RTP/AVP 0 8 101
-a=rtpmap:0 PCMU/8000
-a=rtpmap:8 PCMA/8000
-a=rtpmap:101 telephone-event/8000
-a=sendrecv
-"""
+        sdp = build_sdp(self.get_local_ip(), rtp_port)
         
         response += f"Content-Type: application/sdp\r\n"
         response += f"Content-Length: {len(sdp)}\r\n"
@@ -222,102 +441,238 @@ a=sendrecv
         return response
         
     def get_local_ip(self):
-        """Получение локального IP адреса"""
-        try:
-            # Создаем UDP сокет для определения локального IP
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            local_ip = s.getsockname()[0]
-            s.close()
-            return local_ip
-        except:
-            return "127.0.0.1"
+        """Получение локального IP адреса для SDP"""
+        # Сервер привязан к конкретному адресу - его и объявляем
+        if self.local_ip != '0.0.0.0':
+            return self.local_ip
             
-    def handle_rtp_stream(self, call_id):
-        """Обработка RTP потока для звонка"""
-        if call_id not in self.calls:
-            return
+        # Определяем адрес не на каждый звонок, а раз в LOCAL_IP_TTL секунд
+        # (адрес может смениться, например, при переподключении сети)
+        now = time.monotonic()
+        if self.detected_ip is None or now >= self.detected_ip_expires:
+            try:
+                # Создаем UDP сокет для определения локального IP
+                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                s.connect(("8.8.8.8", 80))
+                self.detected_ip = s.getsockname()[0]
+                s.close()
+                self.detected_ip_expires = now + LOCAL_IP_TTL
+            except:
+                # При ошибке сбрасываем кэш и пробуем снова на следующем звонке
+                self.detected_ip = None
+                return "127.0.0.1"
+                
+        return self.detected_ip
             
-        rtp_port = self.calls[call_id]['rtp_port']
-        logger.info(f"🎤 Запуск RTP обработчика на порту {rtp_port}")
+    def handle_rtp_stream(self, call_id, call, rtp_socket):
+        """Обработка RTP потока для звонка (сокет уже привязан к порту звонка)"""
+        logger.debug("🎤 Запуск RTP обработчика на порту %s", call['rtp_port'])
+        
+        # bytearray растет на месте, без пересоздания буфера на каждый пакет
+        audio_buffer = bytearray()
         
-        # Создаем RTP сокет
-        rtp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        rtp_socket.bind(('0.0.0.0', rtp_port))
-        rtp_socket.settimeout(1.0)
+        # Текущие AI обработка и воспроизведение ответа звонка: новый
+        # фрагмент уходит в AI, только когда предыдущий ответ озвучен
+        ai_future = None
+        playback_future = None
         
-        audio_buffer = b''
+        # Симметричный RTP: источник первого пакета после ответа становится
+        # адресом абонента (и для приема, и для отправки ответов)
+        peer_latched = False
+        
+        # Время последнего пакета от абонента; чужие пакеты его не обновляют
+        last_packet_time = time.monotonic()
         
         try:
-            while call_id in self.calls and self.calls[call_id]['state'] == 'active':
+            # Проверяем состояние по ссылке на звонок, без поиска в self.calls
+            # на каждый пакет; ACK может прийти уже после старта обработчика
+            while call['state'] != 'ended':
+                # Без BYE (потерян по UDP) звонок висел бы вечно, занимая поток
+                # и порт; завершаем его после RTP_TIMEOUT секунд без пакетов от
+                # абонента. Проверка на каждой итерации: поток чужих пакетов
+                # не откладывает таймаут
+                if time.monotonic() - last_packet_time >= RTP_TIMEOUT:
+                    logger.warning("⚠️ Нет RTP пакетов %s сек, звонок %s завершен", RTP_TIMEOUT, call_id)
+                    call['state'] = 'ended'
+                    
+                    # Абонент не должен остаться на мертвой линии
+                    self.send_bye(call_id, call)
+                    break
+                    
+                # Ответ AI готов: воспроизводим его в пуле воспроизведения. Пул AI
+                # занят только распознаванием и генерацией, а прием RTP продолжается,
+                # пока звучит ответ
+                if ai_future is not None and ai_future.done():
+                    # Ошибку задачи уже записал log_task_error
+                    sentences = ai_future.result() if ai_future.exception() is None else None
+                    ai_future = None
+                    if sentences:
+                        playback_future = self.playback_executor.submit(
+                            self.play_response, sentences, call_id, call, rtp_socket
+                        )
+                        playback_future.add_done_callback(log_task_error)
+                        
                 try:
                     # Получаем RTP пакет
                     data, addr = rtp_socket.recvfrom(2048)
                     
-                    if len(data) > 12:  # Минимальный размер RTP заголовка
-                        # Парсим RTP заголовок
-                        rtp_header = struct.unpack('!BBHII', data[:12])
-                        payload = data[12:]
+                    # Порт переиспользуется между звонками: пакеты не от абонента
+                    # этого звонка (например, от прошлого звонка на этом порту)
+                    # отбрасываются и не продлевают звонок
+                    if not peer_latched:
+                        call['rtp_peer'] = addr
+                        peer_latched = True
+                    elif addr != call['rtp_peer']:
+                        continue
+                        
+                    last_packet_time = time.monotonic()
                         
-                        # Добавляем аудио в буфер
-                        audio_buffer += payload
+                    if len(data) > 12:  # Минимальный размер RTP заголовка
+                        # Поля заголовка не используются; аудио данные добавляются
+                        # в буфер через memoryview, без промежуточной копии среза
+                        audio_buffer += memoryview(data)[12:]
                         
-                        # Когда накопилось достаточно аудио (например, 1 секунда)
-                        if len(audio_buffer) > 8000:  # 8kHz * 1 сек
-                            # Обрабатываем через AI
-                            self.process_audio_with_ai(audio_buffer, call_id, rtp_socket, addr)
-                            audio_buffer = b''
+                        # Когда накопилось достаточно аудио (например, 1 секунда).
+                        # AI работает в пуле потоков, прием RTP не блокируется; пока
+                        # предыдущий фрагмент в обработке, аудио копится дальше
+                        reply_in_progress = ai_future is not None or (
+                            playback_future is not None and not playback_future.done()
+                        )
+                        if len(audio_buffer) > 8000 and not reply_in_progress:  # 8kHz * 1 сек
+                            ai_future = self.ai_executor.submit(
+                                self.process_audio_with_ai, audio_buffer, call_id, call
+                            )
+                            ai_future.add_done_callback(log_task_error)
+                            audio_buffer = bytearray()
                             
                 except socket.timeout:
-                    continue
+                    pass
                 except Exception as e:
-                    logger.error(f"❌ Ошибка в RTP: {e}")
+                    logger.error("❌ Ошибка в RTP: %s", e)
+
                     
         finally:
+            # AI обработка в сокет не пишет: незапущенную отменяем, запущенная
+            # сама завершится, увидев состояние 'ended'
+            call['state'] = 'ended'
+            if ai_future is not None:
+                ai_future.cancel()
+                
+            # Воспроизведение пишет в сокет: ждем его (после 'ended' оно
+            # прекращается на следующем пакете) и только потом закрываем сокет
+            if playback_future is not None and not playback_future.cancel():
+                wait([playback_future])
             rtp_socket.close()
-            logger.info(f"🔚 RTP обработчик для звонка {call_id} завершен")
+            logger.info("🔚 RTP обработчик для звонка %s завершен", call_id)
             
-    def process_audio_with_ai(self, audio_data, call_id, rtp_socket, client_addr):
-        """Обработка аудио через AI и отправка ответа"""
+    def process_audio_with_ai(self, audio_data, call_id, call):
+        """Обработка аудио через AI; возвращает предложения ответа для озвучивания"""
         try:
-            logger.info(f"🤖 Обработка аудио через AI для звонка {call_id}")
+            logger.debug("🤖 Обработка аудио через AI для звонка %s", call_id)
             
             # Преобразуем аудио в текст
             text = self.speech_processor.audio_to_text(audio_data)
-            logger.info(f"📝 Распознанный текст: {text}")
             
+            # Абонент положил трубку во время распознавания: ответ не нужен
+            if call['state'] == 'ended':
+                return None
+                
             if text:
                 # Получаем ответ от AI
                 ai_response = self.ai_engine.process_request(text)
-                logger.info(f"🤖 AI ответ: {ai_response}")
                 
-                # Преобразуем ответ в аудио
-                response_audio = self.speech_processor.text_to_audio(ai_response)
+                # Одна запись на реплику вместо отдельных строк на каждом этапе
+                logger.info("🤖 Звонок %s: распознано '%s', AI ответ '%s'", call_id, text, ai_response)
                 
-                # Отправляем аудио обратно через RTP
-                self.send_rtp_audio(rtp_socket, client_addr, response_audio)
+                return split_sentences(ai_response)
                 
         except Exception as e:
-            logger.error(f"❌ Ошибка обработки AI: {e}")
+            logger.error("❌ Ошибка обработки AI: %s", e)
             
-    def send_rtp_audio(self, rtp_socket, addr, audio_data):
+        return None
+        
+    def play_response(self, sentences, call_id, call, rtp_socket):
+        """Синтез и отправка ответа AI через RTP (в пуле воспроизведения)"""
+        try:
+            # Ответ озвучивается по предложениям: первое звучит сразу после
+            # своего синтеза, следующее синтезируется во время воспроизведения
+            next_audio = self.tts_executor.submit(self.speech_processor.text_to_audio, sentences[0])
+            for i in range(len(sentences)):
+                # После завершения звонка оставшиеся предложения не синтезируются
+                if call['state'] == 'ended':
+                    next_audio.cancel()
+                    logger.debug("🔚 Ответ для звонка %s прерван: звонок завершен", call_id)
+                    return
+                    
+                response_audio = next_audio.result()
+                if i + 1 < len(sentences):
+                    next_audio = self.tts_executor.submit(
+                        self.speech_processor.text_to_audio, sentences[i + 1]
+                    )
+                    
+                # Отправляем аудио обратно через RTP
+                if response_audio:
+                    self.send_rtp_audio(rtp_socket, call['rtp_peer'], response_audio, call)
+            
+        except Exception as e:
+            logger.error("❌ Ошибка воспроизведения ответа: %s", e)
+            
+    def send_rtp_audio(self, rtp_socket, addr, audio_data, call):
         """Отправка аудио через RTP"""
         # Простая отправка RTP пакетов
         # В реальности нужно правильно формировать RTP пакеты с timestamp и sequence
         chunk_size = 160  # 20ms при 8kHz
         
-        for i in range(0, len(audio_data), chunk_size):
-            chunk = audio_data[i:i+chunk_size]
+        # Срезы memoryview не копируют аудио данные
+        audio_view = memoryview(audio_data)
+        
+        # Один буфер пакета на весь ответ: заголовок и данные пишутся в него на месте
+        packet = bytearray(RTP_HEADER.size + chunk_size)
+        packet_view = memoryview(packet)
+        
+        # Sequence number и timestamp продолжаются от прошлого ответа звонка.
+        # Timestamp растёт на число 16-битных отсчётов, а пауза между ответами
+        # добавляется по часам (8000 отсчётов в секунду), чтобы он не шёл назад
+        seq = call['rtp_seq']
+        timestamp = call['rtp_timestamp']
+        
+        # Пакеты отправляются по расписанию от общего старта: время на
+        # отправку не накапливается, и поток не спит дольше необходимого
+        next_send = time.monotonic()
+        if call['rtp_time'] is not None:
+            timestamp += max(0, int((next_send - call['rtp_time']) * 8000))
+            
+        # Первый пакет ответа начинает новый фрагмент речи (бит marker)
+        marker = 0x80
+        
+        for i in range(0, len(audio_view), chunk_size):
+            # Звонок завершен: остаток ответа молча отбрасывается, без ошибок
+            # отправки в закрываемый сокет
+            if call['state'] == 'ended':
+                break
+                
+            chunk = audio_view[i:i+chunk_size]
             if chunk:
-                # Простой RTP заголовок (в реальности нужно больше полей)
-                rtp_header = struct.pack('!BBHII', 0x80, 0, i//chunk_size, int(time.time()), 0)
-                rtp_packet = rtp_header + chunk
-                rtp_socket.sendto(rtp_packet, addr)
-                time.sleep(0.02)  # 20ms между пакетами
+                # Простой RTP заголовок: SSRC и тип нагрузки не заполняются
+                RTP_HEADER.pack_into(packet, 0, 0x80, marker, seq & 0xFFFF, timestamp & 0xFFFFFFFF, 0)
+                marker = 0
+                seq += 1
+                timestamp += len(chunk) // 2  # 16-bit отсчёты
+                packet_size = RTP_HEADER.size + len(chunk)
+                packet[RTP_HEADER.size:packet_size] = chunk
+                rtp_socket.sendto(packet_view[:packet_size], addr)
+                
+                next_send += 0.02  # 20ms между пакетами
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                    
+        # Следующий ответ продолжит поток с этого места
+        call['rtp_seq'] = seq & 0xFFFF
+        call['rtp_timestamp'] = timestamp & 0xFFFFFFFF
+        call['rtp_time'] = time.monotonic()
 
 if __name__ == "__main__":
-    import sys
-    
     # Проверяем аргументы командной строки
     local_ip = sys.argv[1] if len(sys.argv) > 1 else '0.0.0.0'
     sip_port = int(sys.argv[2]) if len(sys.argv) > 2 else 5060
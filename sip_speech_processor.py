@@ -3,16 +3,30 @@ Speech Processor для SIP/RTP системы
 Преобразование речи в текст и текста в речь
 """
 
+import hashlib
 import logging
+import os
+import queue
+import tempfile
+import threading
+from collections import OrderedDict
 import whisper
 import numpy as np
 from TTS.api import TTS
 import io
-import wave
-import struct
 
 logger = logging.getLogger(__name__)
 
+# Максимальное число фраз в кэше синтеза речи
+TTS_CACHE_SIZE = 256
+
+# Каталог дискового кэша фиксированных фраз (переживает перезапуск сервера)
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', 'recordings/tts_cache')
+
+# Модель синтеза речи; входит в ключ дискового кэша, чтобы после смены
+# модели не воспроизводилась речь, синтезированная старой
+TTS_MODEL_NAME = "tts_models/en/ljspeech/tacotron2-DDC"
+
 class SpeechProcessor:
     """Обработчик речи для SIP системы"""
     
@@ -24,9 +38,28 @@ class SpeechProcessor:
         
         # Загружаем TTS модель
         logger.info("📦 Загрузка TTS модели...")
-        self.tts = TTS(model_name="tts_models/en/ljspeech/tacotron2-DDC")
+        self.tts = TTS(model_name=TTS_MODEL_NAME)
         logger.info("✅ TTS модель загружена")
         
+        # Кэш синтезированных фраз: повторяющиеся ответы (например,
+        # сообщения об ошибках) не синтезируются заново
+        self.tts_cache = OrderedDict()
+        self.tts_cache_lock = threading.Lock()
+        
+        # Дисковый кэш необязателен: без каталога сервер работает только
+        # с кэшем в памяти
+        self.tts_disk_cache = True
+        try:
+            os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+        except OSError as e:
+            logger.warning("⚠️ Дисковый кэш речи отключен, каталог %s недоступен: %s", TTS_CACHE_DIR, e)
+            self.tts_disk_cache = False
+        
+        # Запись в дисковый кэш выполняет отдельный поток, чтобы дисковый
+        # ввод-вывод не задерживал отправку синтезированной речи в звонок
+        self.tts_cache_writes = queue.SimpleQueue()
+        threading.Thread(target=self._tts_cache_writer, name="tts-cache-writer", daemon=True).start()
+        
     def audio_to_text(self, audio_data: bytes, sample_rate: int = 8000) -> str:
         """
         Преобразование аудио в текст
@@ -42,8 +75,9 @@ class SpeechProcessor:
             # Преобразуем байты в numpy array
             audio_array = np.frombuffer(audio_data, dtype=np.int16)
             
-            # Нормализуем аудио
-            audio_float = audio_array.astype(np.float32) / 32768.0
+            # Нормализуем аудио на месте, без промежуточного массива
+            audio_float = audio_array.astype(np.float32)
+            audio_float *= 1.0 / 32768.0
             
             # Если частота не 16kHz (требование Whisper), делаем ресемплинг
             if sample_rate != 16000:
@@ -58,24 +92,95 @@ class SpeechProcessor:
             result = self.whisper_model.transcribe(audio_float, language="ru")
             text = result["text"].strip()
             
-            logger.info(f"📝 Распознан текст: {text}")
+            logger.debug("📝 Распознан текст: %s", text)
             return text
             
         except Exception as e:
-            logger.error(f"❌ Ошибка распознавания речи: {e}")
+            logger.error("❌ Ошибка распознавания речи: %s", e)
             return ""
             
-    def text_to_audio(self, text: str, sample_rate: int = 8000) -> bytes:
+    def text_to_audio(self, text: str, sample_rate: int = 8000, persist: bool = False) -> bytes:
         """
         Преобразование текста в аудио
         
         Args:
             text: Текст для синтеза
             sample_rate: Частота дискретизации для вывода
+            persist: Сохранить результат в дисковый кэш (только для фиксированных фраз)
             
         Returns:
             Аудио данные в формате bytes
         """
+        cache_key = (text, sample_rate)
+        with self.tts_cache_lock:
+            audio_data = self.tts_cache.get(cache_key)
+            if audio_data is not None:
+                self.tts_cache.move_to_end(cache_key)
+                logger.debug("🔊 Речь из кэша для: %.50s...", text)
+                return audio_data
+                
+        cache_path = self._tts_cache_path(text, sample_rate) if self.tts_disk_cache else None
+        audio_data = None
+        if cache_path is not None:
+            try:
+                with open(cache_path, 'rb') as f:
+                    audio_data = f.read()
+                logger.debug("🔊 Речь из дискового кэша для: %.50s...", text)
+            except OSError:
+                pass
+                
+        if audio_data is None:
+            audio_data = self._synthesize(text, sample_rate)
+            
+            # Ошибки синтеза (пустой результат) не кэшируем
+            if not audio_data:
+                return audio_data
+                
+            # На диск попадают только фиксированные фразы: ответы AI почти не
+            # повторяются, и каталог кэша рос бы без ограничений
+            if persist and cache_path is not None:
+                self.tts_cache_writes.put((cache_path, audio_data))
+            
+        with self.tts_cache_lock:
+            self.tts_cache[cache_key] = audio_data
+            if len(self.tts_cache) > TTS_CACHE_SIZE:
+                self.tts_cache.popitem(last=False)
+                
+        return audio_data
+        
+    def _tts_cache_path(self, text: str, sample_rate: int) -> str:
+        """Путь к файлу дискового кэша: SHA-256 от модели, частоты и нормализованного текста"""
+        normalized = " ".join(text.split())
+        key = hashlib.sha256(f"{TTS_MODEL_NAME}:{sample_rate}:{normalized}".encode('utf-8')).hexdigest()
+        return os.path.join(TTS_CACHE_DIR, key + ".pcm")
+        
+    def _tts_cache_writer(self):
+        """Фоновая запись синтезированной речи в дисковый кэш"""
+        while True:
+            cache_path, audio_data = self.tts_cache_writes.get()
+            try:
+                self._write_tts_cache(cache_path, audio_data)
+            except Exception as e:
+                # Поток записи единственный: ошибка не должна его останавливать,
+                # иначе очередь копила бы аудио без конца
+                logger.error("❌ Ошибка записи в кэш речи: %s", e)
+            
+    def _write_tts_cache(self, cache_path: str, audio_data: bytes):
+        """Атомарная запись в дисковый кэш: читатели не увидят частичный файл"""
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=TTS_CACHE_DIR, suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(audio_data)
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning("⚠️ Не удалось сохранить речь в кэш: %s", e)
+            
+    def _synthesize(self, text: str, sample_rate: int) -> bytes:
+        """Синтез речи без кэша"""
         try:
             # Генерируем речь
             with io.BytesIO() as wav_buffer:
@@ -98,11 +203,11 @@ class SpeechProcessor:
                 # Генерируем тишину (в реальности здесь должна быть речь)
                 audio_data = b'\x00' * (samples * 2)  # 16-bit samples
                 
-            logger.info(f"🔊 Синтезирована речь для: {text[:50]}...")
+            logger.debug("🔊 Синтезирована речь для: %.50s...", text)
             return audio_data
             
         except Exception as e:
-            logger.error(f"❌ Ошибка синтеза речи: {e}")
+            logger.error("❌ Ошибка синтеза речи: %s", e)
             return b''
             
     def convert_audio_format(self, audio_data: bytes, from_rate: int, to_rate: int) -> bytes:
@@ -136,5 +241,5 @@ class SpeechProcessor:
             return resampled.astype(np.int16).tobytes()
             
         except Exception as e:
-            logger.error(f"❌ Ошибка конвертации аудио: {e}")
+            logger.error("❌ Ошибка конвертации аудио: %s", e)
             return audio_data
\ No newline at end of file
@@ -4,14 +4,55 @@ Voice AI Engine для SIP/RTP системы
 """
 
 import logging
-import time
-from typing import List, Dict
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import orjson
 import os
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# Максимум keep-alive соединений к Ollama: запросы идут из потоков AI
+# обработки (AI_WORKERS) и из фоновых потоков проверки и прогрева модели
+OLLAMA_POOL_SIZE = int(os.getenv('AI_WORKERS', '4')) + 2
+
+# Заголовки запроса с JSON телом
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Системный промпт
+SYSTEM_PROMPT = """Вы - вежливый и профессиональный голосовой ассистент компании Prime Cargo Logistics.
+Ваша задача - помогать клиентам с вопросами о доставке, отслеживании груза и других услугах компании.
+Отвечайте кратко и по существу, помните что это телефонный разговор."""
+
+# Системная часть промпта не меняется, поэтому форматируется один раз
+SYSTEM_PROMPT_PREFIX = f"System: {SYSTEM_PROMPT}\n\n"
+
+# Повторный прогрев модели не чаще одного раза за столько секунд
+# (Ollama держит модель в памяти 5 минут после запроса)
+OLLAMA_WARM_INTERVAL = 60.0
+
+# Предел ожидания прогрева (загрузка модели с диска может быть долгой)
+OLLAMA_WARM_TIMEOUT = 60.0
+
+# Фиксированные ответы на случай ошибок (озвучиваются заранее при запуске)
+OLLAMA_ERROR_RESPONSE = "Извините, произошла ошибка при обработке запроса."
+OLLAMA_UNAVAILABLE_RESPONSE = "Извините, AI сервер временно недоступен."
+UNEXPECTED_ERROR_RESPONSE = "Извините, произошла непредвиденная ошибка."
+GENERATION_ERROR_RESPONSE = "Извините, произошла ошибка. Пожалуйста, повторите ваш вопрос."
+FALLBACK_RESPONSES = (
+    OLLAMA_ERROR_RESPONSE,
+    OLLAMA_UNAVAILABLE_RESPONSE,
+    UNEXPECTED_ERROR_RESPONSE,
+    GENERATION_ERROR_RESPONSE,
+)
+
+# Префиксы реплик в промпте по роли сообщения
+ROLE_PREFIXES = {
+    "user": "User: ",
+    "assistant": "Assistant: ",
+}
+
 class VoiceAIEngine:
     """AI движок для обработки голосовых запросов"""
     
@@ -19,22 +60,74 @@ class VoiceAIEngine:
         self.conversation_history = []
         self.ollama_url = os.getenv('OLLAMA_URL', 'http://localhost:11434')
         self.model_name = os.getenv('OLLAMA_MODEL', 'llama3.1:8b-instruct-q4_0')
+        self.generate_url = f"{self.ollama_url}/api/generate"
+        self.warm_expires = 0.0
+        
+        # Занята, пока идет запрос прогрева: одновременно не больше одного
+        self.warm_lock = threading.Lock()
         
-        # Проверяем доступность Ollama
+        # Постоянная HTTP сессия: соединение с Ollama переиспользуется между запросами.
+        # Пул рассчитан на одновременные запросы, иначе лишние соединения закрываются
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=OLLAMA_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+        # Проверка доступности Ollama идет в фоне и не задерживает запуск
+        # сервера; результат нужен только для диагностики в логах
+        threading.Thread(target=self._check_ollama, name="ollama-check", daemon=True).start()
+        
+    def _check_ollama(self):
+        """Проверка доступности Ollama и наличия модели"""
         try:
-            response = requests.get(f"{self.ollama_url}/api/tags")
+            response = self.session.get(f"{self.ollama_url}/api/tags")
             if response.status_code == 200:
                 logger.info("✅ Ollama сервер доступен")
-                models = response.json().get('models', [])
-                model_names = [m['name'] for m in models]
+                models = orjson.loads(response.content).get('models', [])
+                model_names = {m['name'] for m in models}
                 if self.model_name in model_names:
-                    logger.info(f"✅ Модель {self.model_name} найдена")
+                    logger.info("✅ Модель %s найдена", self.model_name)
                 else:
-                    logger.warning(f"⚠️ Модель {self.model_name} не найдена. Доступные модели: {model_names}")
+                    logger.warning("⚠️ Модель %s не найдена. Доступные модели: %s", self.model_name, sorted(model_names))
             else:
                 logger.error("❌ Ollama сервер недоступен")
         except Exception as e:
-            logger.error(f"❌ Ошибка подключения к Ollama: {e}")
+            logger.error("❌ Ошибка подключения к Ollama: %s", e)
+            
+    def warm_up(self):
+        """Загрузка модели в память Ollama до первой реплики звонка (не блокирует)"""
+        if time.monotonic() < self.warm_expires:
+            return
+            
+        # Прогрев уже идет: второй запрос не нужен
+        if not self.warm_lock.acquire(blocking=False):
+            return
+            
+        now = time.monotonic()
+        if now < self.warm_expires:
+            self.warm_lock.release()
+            return
+        self.warm_expires = now + OLLAMA_WARM_INTERVAL
+        
+        # Запрос идет в отдельном потоке, а не в пуле AI: медленная загрузка
+        # модели не занимает потоки распознавания и генерации ответов
+        threading.Thread(target=self._warm_model, name="ollama-warm", daemon=True).start()
+        
+    def _warm_model(self):
+        """Запрос прогрева модели Ollama"""
+        try:
+            # Запрос без промпта только загружает модель, ответ не генерируется
+            self.session.post(
+                self.generate_url,
+                data=orjson.dumps({"model": self.model_name}),
+                headers=JSON_HEADERS,
+                timeout=OLLAMA_WARM_TIMEOUT
+            )
+            logger.debug("🔥 Модель %s прогрета", self.model_name)
+        except Exception as e:
+            logger.warning("⚠️ Не удалось прогреть модель Ollama: %s", e)
+        finally:
+            self.warm_lock.release()
             
     def process_request(self, text: str) -> str:
         """
@@ -50,34 +143,24 @@ class VoiceAIEngine:
             # Добавляем в историю
             self.conversation_history.append({"role": "user", "content": text})
             
-            # Системный промпт
-            system_prompt = """Вы - вежливый и профессиональный голосовой ассистент компании Prime Cargo Logistics.
-Ваша задача - помогать клиентам с вопросами о доставке, отслеживании груза и других услугах компании.
-Отвечайте кратко и по существу, помните что это телефонный разговор."""
-            
-            # Формируем сообщения для API
-            messages = [
-                {"role": "system", "content": system_prompt}
-            ] + self.conversation_history[-10:]  # Последние 10 сообщений
-            
             # Запрос к Ollama
             try:
-                # Формируем промпт из истории сообщений
-                prompt = ""
-                for msg in messages:
-                    if msg["role"] == "system":
-                        prompt += f"System: {msg['content']}\n\n"
-                    elif msg["role"] == "user":
-                        prompt += f"User: {msg['content']}\n"
-                    elif msg["role"] == "assistant":
-                        prompt += f"Assistant: {msg['content']}\n"
+                # Формируем промпт: готовый системный префикс + последние 10 сообщений
+                prompt_parts = [SYSTEM_PROMPT_PREFIX]
+                for msg in self.conversation_history[-10:]:
+                    prefix = ROLE_PREFIXES.get(msg["role"])
+                    if prefix:
+                        prompt_parts.append(f"{prefix}{msg['content']}\n")
                 
-                prompt += "Assistant: "
+                prompt_parts.append("Assistant: ")
+                prompt = "".join(prompt_parts)
                 
                 # Отправляем запрос к Ollama
-                response = requests.post(
-                    f"{self.ollama_url}/api/generate",
-                    json={
+                # Тело сериализуется через orjson: промпт с кириллицей уходит
+                # как UTF-8, без \uXXXX экранирования stdlib json
+                response = self.session.post(
+                    self.generate_url,
+                    data=orjson.dumps({
                         "model": self.model_name,
                         "prompt": prompt,
                         "stream": False,
@@ -85,31 +168,32 @@ class VoiceAIEngine:
                             "temperature": 0.7,
                             "num_predict": 150  # Максимум токенов для короткого ответа
                         }
-                    }
+                    }),
+                    headers=JSON_HEADERS
                 )
                 
                 if response.status_code == 200:
-                    ai_response = response.json()['response'].strip()
+                    ai_response = orjson.loads(response.content)['response'].strip()
                 else:
-                    logger.error(f"❌ Ошибка от Ollama: {response.status_code} - {response.text}")
-                    ai_response = "Извините, произошла ошибка при обработке запроса."
+                    logger.error("❌ Ошибка от Ollama: %s - %s", response.status_code, response.text)
+                    ai_response = OLLAMA_ERROR_RESPONSE
                     
             except requests.exceptions.ConnectionError:
                 logger.error("❌ Не удалось подключиться к Ollama. Убедитесь, что сервер запущен.")
-                ai_response = "Извините, AI сервер временно недоступен."
+                ai_response = OLLAMA_UNAVAILABLE_RESPONSE
             except Exception as e:
-                logger.error(f"❌ Неожиданная ошибка при запросе к Ollama: {e}")
-                ai_response = "Извините, произошла непредвиденная ошибка."
+                logger.error("❌ Неожиданная ошибка при запросе к Ollama: %s", e)
+                ai_response = UNEXPECTED_ERROR_RESPONSE
             
             # Добавляем ответ в историю
             self.conversation_history.append({"role": "assistant", "content": ai_response})
             
-            logger.info(f"🤖 AI ответ: {ai_response}")
+            logger.debug("🤖 AI ответ: %s", ai_response)
             return ai_response
             
         except Exception as e:
-            logger.error(f"❌ Ошибка генерации ответа: {e}")
-            return "Извините, произошла ошибка. Пожалуйста, повторите ваш вопрос."
+            logger.error("❌ Ошибка генерации ответа: %s", e)
+            return GENERATION_ERROR_RESPONSE
             
     def reset_conversation(self):
         """Сброс истории разговора"""
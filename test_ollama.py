@@ -12,11 +12,14 @@ def test_ollama():
     ollama_url = "http://localhost:11434"
     model_name = "llama3.1:8b-instruct-q4_0"
     
+    # Одна сессия на оба запроса: соединение с Ollama переиспользуется
+    session = requests.Session()
+    
     print("🔍 Проверка Ollama сервера...")
     
     # Проверяем доступность сервера
     try:
-        response = requests.get(f"{ollama_url}/api/tags")
+        response = session.get(f"{ollama_url}/api/tags")
         if response.status_code == 200:
             print("✅ Ollama сервер доступен")
             
@@ -28,7 +31,7 @@ def test_ollama():
                     print(f"   - {model['name']} ({model['size']} bytes)")
                     
                 # Проверяем нашу модель
-                model_names = [m['name'] for m in models]
+                model_names = {m['name'] for m in models}
                 if model_name in model_names:
                     print(f"\n✅ Модель {model_name} найдена")
                 else:
@@ -51,7 +54,7 @@ def test_ollama():
     try:
         test_prompt = "Привет! Ответь одним предложением."
         
-        response = requests.post(
+        response = session.post(
             f"{ollama_url}/api/generate",
             json={
                 "model": model_name,